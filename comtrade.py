@@ -12,44 +12,47 @@ comtrade module:
         # 1. parser.analog: a dict for analog channel data;
         # 2. parser.digital: a dict for digital channel data;
         # 3. parser.result: record the parse result for comtrade file
+
+    To parse a batch of comtrade files in parallel, use parse_many:
+        parsers = parse_many(['1.cfg', '2.cfg', '3.cfg'])
 """
+from concurrent.futures import ProcessPoolExecutor
+from functools import cached_property
 import matplotlib.pyplot as plt
+import mmap
 import numpy as np
 import os.path as op
-import struct
 
 plt.rcParams['font.family'] = ['SimHei'] #指定默认字体  
 plt.rcParams['axes.unicode_minus'] = False #解决保存图像是负号'-'显示为方块的问题 
 
+# field name and type of each column in the cfg channel lines
+_ANALOG_SCHEMA = [('num', int), ('ch_id', str), ('phase', str),
+                  ('ccbm', str), ('unit', str), ('a', float), ('b', float),
+                  ('skew', float), ('min', float), ('max', float),
+                  ('primary', float), ('secondary', float), ('ps', str)]
+_DIGITAL_SCHEMA = [('num', int), ('ch_id', str), ('phase', str),
+                   ('ccbm', str), ('y', int)]
+
 class AnalogInfo:
     """
     Comtrade config file: Analog channel info
     including the analog channel data information
     """
     def __init__(self, infoStr='1,UA,A,FI,V,1,0,0,-32767,32767,1,1,p'):
-        self.str = infoStr.replace('\n', '')
-        buf = self.str.split(',')
-        self.num = int(buf[0])
-        self.ch_id = buf[1]
-        self.phase = buf[2]
-        self.ccbm = buf[3]
-        self.unit = buf[4]
-        self.a = float(buf[5])
-        self.b = float(buf[6])
-        self.skew = float(buf[7])
-        self.min = float(buf[8])
-        self.max = float(buf[9])
-        self.primary = float(buf[10])
-        self.secondary = float(buf[11])
-        self.ps = buf[12]
-        self._data = []
-
-    def appendData(self, rawValue):
-        value = rawValue * self.a + self.b
-        self._data.append(value)
+        self.str = infoStr
+        buf = infoStr.split(',')
+        if len(buf) < len(_ANALOG_SCHEMA):
+            raise ValueError('invalid analog channel info: %s' % infoStr)
+        for (name, cast), value in zip(_ANALOG_SCHEMA, buf):
+            setattr(self, name, cast(value))
+        self._parent = None
+        self._col = 0
 
     def data(self):
-        return np.array(self._data)
+        if self._parent is None:
+            return np.zeros(0)
+        return self._parent.analogMat[:, self._col]
 
     def __repr__(self):
         return self.str
@@ -61,24 +64,19 @@ class DigitalInfo:
     including the digital channel data information
     """
     def __init__(self, infoStr='1,ASOE,,,0'):
-        self.str = infoStr.replace('\n', '')
-        buf = self.str.split(',')
-        self.num = int(buf[0])
-        self.ch_id = buf[1]
-        self.phase = buf[2]
-        self.ccbm = buf[3]
-        self.y = int(buf[4])
-        self._data = []
-
-    def appendData(self, value):
-        if value & (0x0001 << self.num):
-            value = 1
-        else:
-            value = 0
-        self._data.append(value)
+        self.str = infoStr
+        buf = infoStr.split(',')
+        if len(buf) < len(_DIGITAL_SCHEMA):
+            raise ValueError('invalid digital channel info: %s' % infoStr)
+        for (name, cast), value in zip(_DIGITAL_SCHEMA, buf):
+            setattr(self, name, cast(value))
+        self._parent = None
+        self._col = 0
 
     def data(self):
-        return np.array(self._data)
+        if self._parent is None:
+            return np.zeros(0, dtype=np.uint8)
+        return self._parent.digitalMat[:, self._col]
 
     def __repr__(self):
         return self.str
@@ -87,7 +85,7 @@ class DigitalInfo:
 class FileInfo:
     'Comtrade config file: File info'
     def __init__(self, infoStr):
-        self.str = infoStr.replace('\n', '')
+        self.str = infoStr
         buf = self.str.split(',')
         self.station_name = buf[0]
         self.rec_dev_id = int(buf[1])
@@ -102,7 +100,7 @@ class FileInfo:
 class ChannelInfo:
     'Comtrade config file: Channel info'
     def __init__(self, infoStr):
-        self.str = infoStr.replace('\n', '')
+        self.str = infoStr
         buf = self.str.split(',')
         self.total = int(buf[0])
         self.analog = 0
@@ -125,7 +123,7 @@ class ChannelInfo:
 class SampleInfo:
     'Comtrade config file: Sample info'
     def __init__(self, infoStr):
-        self.str = infoStr.replace('\n', '')
+        self.str = infoStr
         buf = self.str.split(',')
         self.rate = float(buf[0])
         self.end = int(buf[1])
@@ -138,7 +136,7 @@ class SampleInfo:
 class TimeStamp:
     'Comtrade config file: Time Stamp'
     def __init__(self, infoStr):
-        self.str = infoStr.replace('\n', '')
+        self.str = infoStr
         buf = self.str.split(',')
         dateList = buf[0].split('/')
         timeList = buf[1].split(':')
@@ -162,11 +160,8 @@ class ComtradeConfig:
             return
         else:
             self.result = 'parsing'
-        f = open(self.path)
-        lines = f.readlines()
-        f.close()
-        del f
-        lines = self._removeNextline(lines)
+        with open(self.path) as f:
+            lines = f.read().splitlines()
         self._parse(lines)
 
     def _parse(self, infoStrs):
@@ -200,18 +195,17 @@ class ComtradeConfig:
         self.timemult = float(infoStrs[index])
         self.result = 'parsed'
 
-    def _removeNextline(self, strList):
-        result = []
-        for each in strList:
-            result.append(each.replace('\n', ''))
-        return result
-
 class ComtradeData:
-    'Comtrade dat file parser'
+    """
+    Comtrade dat file parser
+    the records are read at init, the analog and digital channels are
+    decoded on first access only
+    """
     def __init__(self, config):
         self.result = 'none'
         pathList = config.path.split('.')
         self.path = pathList[0] + '.dat'
+        self._records = None
         if config.result != 'parsed':
             return
         if not op.exists(self.path):
@@ -219,59 +213,126 @@ class ComtradeData:
             return
         else:
             self.result = 'parsing'
-        datFile = open(self.path, 'rb')
-        data = datFile.read()
-        size = datFile.tell()
-        datFile.close()
-        del datFile
         analogChNum = config.channelInfo.analog
         digitalChNum = config.channelInfo.digital
-        analogBytesLen = 2 * analogChNum
-        digitalBytesLen = 0
-        if digitalChNum % 16 != 0:
-            digitalBytesLen =  2 * ((digitalChNum // 16) + 1)
-        else:
-            digitalBytesLen = 2 * (digitalChNum // 16)
-        self.unitSize = 4 + 4 + digitalBytesLen + analogBytesLen
+        digitalWords = (digitalChNum + 15) // 16
+        # one record: sample number, timestamp, analog words, digital words
+        dt = np.dtype({'names': ['n', 't', 'a', 'd'],
+                       'formats': ['<u4', '<i4',
+                                   (np.dtype('<i2'), (analogChNum,)),
+                                   (np.dtype('<u2'), (digitalWords,))]})
+        self.unitSize = dt.itemsize
         self.sampleCount = config.sampleInfo[0].end
+        # a truncated dat file only holds the complete records it contains
+        size = op.getsize(self.path)
+        if size < self.unitSize * self.sampleCount:
+            self.sampleCount = size // self.unitSize
         self.deltaT = 1.0 / config.sampleInfo[0].rate
+        self._t = np.arange(self.sampleCount, dtype=np.float64) * self.deltaT
         self.config = config
-        for i in range(0, self.sampleCount):
-            analogIndex = i * self.unitSize + 8
-            for ch in range(0, analogChNum):
-                index = ch * 2 + analogIndex
-                raw = struct.unpack('h', data[index:index+2])[0]
-                self.config.analogInfo[ch].appendData(raw)
-            digitalIndex = i * self.unitSize + 8 + analogBytesLen
-            for ch in range(0, digitalChNum):
-                index = (ch // 16) * 2 + digitalIndex
-                raw = struct.unpack('h', data[index:index+2])[0] 
-                self.config.digitalInfo[ch].appendData(raw)
-        self._analog = {}
-        self._digital = {}
-        for each in self.config.analogInfo:
-            self._analog[each.ch_id + '(%s)' % each.unit] = each.data()
-        for each in self.config.digitalInfo:
-            self._digital[each.ch_id] = each.data()
+        if self.sampleCount > 0:
+            # map the dat file and copy the records out of it, the lazy
+            # decode must never read from a map whose file may have changed
+            with open(self.path, 'rb') as datFile, \
+                    mmap.mmap(datFile.fileno(), 0,
+                              access=mmap.ACCESS_READ) as data:
+                records = np.frombuffer(data, dtype=dt,
+                                        count=self.sampleCount)
+                self._records = records.copy()
+                # drop the view, the map can't close while it is exported
+                del records
+        else:
+            self._records = np.zeros(0, dtype=dt)
+        self._bind_channels()
         self.result = 'parsed'
 
+    def _bind_channels(self):
+        # the channel infos only keep their column of the shared matrices
+        for ch, each in enumerate(self.config.analogInfo):
+            each._parent = self
+            each._col = ch
+        for ch, each in enumerate(self.config.digitalInfo):
+            each._parent = self
+            each._col = ch
+
+    def _decode_analog(self):
+        if self.result != 'parsed':
+            return np.zeros((0, 0))
+        analogRaw = self._records['a']
+        analogChNum = analogRaw.shape[1]
+        aVec = np.fromiter((each.a for each in self.config.analogInfo),
+                           dtype=np.float64, count=analogChNum)
+        bVec = np.fromiter((each.b for each in self.config.analogInfo),
+                           dtype=np.float64, count=analogChNum)
+        # write the scaled values into one preallocated buffer, no
+        # intermediate product/sum temporaries
+        analogMat = np.empty((self.sampleCount, analogChNum),
+                             dtype=np.float64)
+        np.multiply(analogRaw, aVec, out=analogMat)
+        analogMat += bVec
+        return analogMat
+
+    def _decode_digital(self):
+        if self.result != 'parsed':
+            return np.zeros((0, 0), dtype=np.uint8)
+        digitalRaw = self._records['d']
+        digitalChNum = len(self.config.digitalInfo)
+        # channel ch lives in bit (ch % 16) of word (ch // 16): unpack the
+        # little-endian words LSB first, each word is read only once
+        bits = np.unpackbits(digitalRaw.view(np.uint8), axis=1,
+                             bitorder='little')
+        return bits[:, :digitalChNum]
+
+    @cached_property
+    def analogMat(self):
+        analogMat = self._decode_analog()
+        # the raw records are only needed until both sides are decoded
+        if 'digitalMat' in self.__dict__:
+            self._records = None
+        return analogMat
+
+    @cached_property
+    def digitalMat(self):
+        digitalMat = self._decode_digital()
+        if 'analogMat' in self.__dict__:
+            self._records = None
+        return digitalMat
+
+    def decode(self):
+        """
+        decode the analog and digital channels now instead of on first
+        access, return (analogMat, digitalMat)
+        """
+        return self.analogMat, self.digitalMat
+
+    def __getstate__(self):
+        # the channel dicts are column views, they are rebuilt on access
+        state = self.__dict__.copy()
+        state.pop('analog', None)
+        state.pop('digital', None)
+        return state
+
     def t(self):
         if self.result == 'parsed':
-            return (np.linspace(0.0, self.deltaT * self.sampleCount, self.sampleCount))
+            return self._t
         else:
             return np.zeros(0)
 
+    @cached_property
     def analog(self):
+        result = {}
         if self.result == 'parsed':
-            return self._analog
-        else:
-            return {}
-    
+            for each in self.config.analogInfo:
+                result[each.ch_id + '(%s)' % each.unit] = each.data()
+        return result
+
+    @cached_property
     def digital(self):
+        result = {}
         if self.result == 'parsed':
-            return self._digital
-        else:
-            return {}
+            for each in self.config.digitalInfo:
+                result[each.ch_id] = each.data()
+        return result
 
 class ComtradeParser:
     """
@@ -298,12 +359,23 @@ class ComtradeParser:
         self.result = 'parsing'
         self.config = ComtradeConfig(self.path + '.cfg')
         self.dat = ComtradeData(self.config)
-        self.analog = self.dat.analog()
-        self.digital = self.dat.digital()
+        if self.config.result != 'parsed':
+            self.result = self.config.result
+            return
         self.result = 'parsed'
         self.t = self.dat.t()
         self.fs = self.config.sampleInfo[0].rate
 
+    @property
+    def analog(self):
+        'analog channel data dict, decoded on first access'
+        return self.dat.analog
+
+    @property
+    def digital(self):
+        'digital channel data dict, decoded on first access'
+        return self.dat.digital
+
     def _savecsvdata(self,filePath , chtype='analog'):
         chtype = chtype.lower()
         if chtype == 'analog':
@@ -312,18 +384,15 @@ class ComtradeParser:
             rawdict = self.digital
         else:
             rawdict = dict(self.analog, **self.digital)
-        datalist = list(rawdict.values())
-        datamatrix = np.array(datalist)
-        csvdata = datamatrix.transpose()
-        np.savetxt(filePath, csvdata, fmt='%.2f', delimiter=',')
-        f = open(filePath, 'r')
-        lines = f.readlines()
-        f.close()
-        tablehead = ','.join(rawdict.keys()) + '\n'
-        lines.insert(0, tablehead)
-        f = open(filePath, 'w')
-        f.writelines(lines)
-        f.close()
+        # stack the channel columns into a row-contiguous (N, C) matrix,
+        # savetxt writes it row by row
+        if rawdict:
+            csvdata = np.column_stack(list(rawdict.values()))
+        else:
+            csvdata = np.zeros((0, 0))
+        tablehead = ','.join(rawdict.keys())
+        np.savetxt(filePath, csvdata, fmt='%.2f', delimiter=',',
+                   header=tablehead, comments='')
 
     def show(self):
         """
@@ -375,11 +444,42 @@ class ComtradeParser:
             row = count // 2 + (count % 2)
             column = 2
             plt.close('all')
-            plt.figure(figsize=(16, count*1))
-            plt.suptitle(title)
-            subplotN = 1
+            fig, axes = plt.subplots(max(row, 1), column,
+                                     figsize=(16, count*1), squeeze=False)
+            fig.suptitle(title)
+            axIter = iter(axes.flat)
             for key, data in data.items():
-                plt.subplot(row, column, subplotN)
-                subplotN += 1
-                plt.plot(self.t, data, label=key) 
-                plt.legend()
+                ax = next(axIter)
+                ax.plot(self.t, data, label=key)
+                ax.legend()
+            for ax in axIter:
+                ax.set_visible(False)
+
+def _parse_decoded(path):
+    'parse a comtrade file and decode all its channels, for parse_many'
+    try:
+        parser = ComtradeParser(path)
+    except (OSError, ValueError, IndexError) as e:
+        # report a malformed file in its own result, not for the whole batch
+        parser = ComtradeParser.__new__(ComtradeParser)
+        parser.path = path
+        parser.result = 'parse failed: %s' % e
+        return parser
+    if parser.result == 'parsed':
+        parser.dat.decode()
+    return parser
+
+def parse_many(paths, n_workers=None, chunksize=4):
+    """
+    parse a batch of comtrade files in worker processes, return the list of
+    ComtradeParser in the same order as paths. The channels are decoded in
+    the workers, so the parsers come back fully decoded. A file that can't
+    be parsed doesn't stop the batch, its parser.result tells the error.
+    - n_workers: the number of worker processes, default is the cpu count
+    - chunksize: the number of files sent to a worker at a time
+    Tip:
+      the workers never draw, they use the Agg backend to skip gui setup
+    """
+    with ProcessPoolExecutor(n_workers, initializer=plt.switch_backend,
+                             initargs=('Agg',)) as executor:
+        return list(executor.map(_parse_decoded, paths, chunksize=chunksize))
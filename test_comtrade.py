@@ -0,0 +1,150 @@
+"""
+round-trip tests for the comtrade module: write a synthetic binary
+cfg/dat pair and check what ComtradeParser reads back.
+
+Run: python3 -m unittest test_comtrade
+"""
+import os
+import os.path as op
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import comtrade
+
+ANALOG_A = [0.5, 2.0, 0.01]
+ANALOG_B = [1.0, -3.0, 0.0]
+DIGITAL_NUM = 20
+SAMPLE_COUNT = 50
+SAMPLE_RATE = 1000.0
+
+
+def writewave(dirpath, name='wave', sampleCount=SAMPLE_COUNT):
+    """
+    write a binary comtrade file with 3 analog and 20 digital channels,
+    return (cfg path, raw analog values, digital bits)
+    """
+    rng = np.random.default_rng(0)
+    analogNum = len(ANALOG_A)
+    words = (DIGITAL_NUM + 15) // 16
+    raw = rng.integers(-32768, 32768, (sampleCount, analogNum))
+    bits = rng.integers(0, 2, (sampleCount, DIGITAL_NUM))
+    lines = ['station,1,1999',
+             '%d,%dA,%dD' % (analogNum + DIGITAL_NUM, analogNum, DIGITAL_NUM)]
+    for ch in range(analogNum):
+        lines.append('%d,U%d,A,,V,%s,%s,0,-32767,32767,1,1,p'
+                     % (ch + 1, ch, ANALOG_A[ch], ANALOG_B[ch]))
+    for ch in range(DIGITAL_NUM):
+        lines.append('%d,S%d,,,0' % (ch + 1, ch))
+    lines += ['50', '1', '%g,%d' % (SAMPLE_RATE, sampleCount),
+              '01/02/2018,10:00:00.000', '01/02/2018,10:00:00.100',
+              'BINARY', '1']
+    path = op.join(dirpath, name)
+    with open(path + '.cfg', 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    dt = np.dtype([('n', '<u4'), ('t', '<i4'), ('a', '<i2', (analogNum,)),
+                   ('d', '<u2', (words,))])
+    records = np.zeros(sampleCount, dtype=dt)
+    records['n'] = np.arange(1, sampleCount + 1)
+    records['a'] = raw
+    # channel ch is bit (ch % 16) of status word (ch // 16)
+    for ch in range(DIGITAL_NUM):
+        records['d'][:, ch // 16] |= (bits[:, ch] << (ch % 16)).astype('<u2')
+    records.tofile(path + '.dat')
+    return path + '.cfg', raw, bits
+
+
+class ComtradeParserTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cfg, self.raw, self.bits = writewave(self.dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_analog(self):
+        parser = comtrade.ComtradeParser(self.cfg)
+        self.assertEqual(parser.result, 'parsed')
+        self.assertEqual(list(parser.analog), ['U0(V)', 'U1(V)', 'U2(V)'])
+        for ch, data in enumerate(parser.analog.values()):
+            expected = self.raw[:, ch] * ANALOG_A[ch] + ANALOG_B[ch]
+            np.testing.assert_allclose(data, expected)
+
+    def test_digital_bits(self):
+        parser = comtrade.ComtradeParser(self.cfg)
+        self.assertEqual(len(parser.digital), DIGITAL_NUM)
+        for ch, data in enumerate(parser.digital.values()):
+            self.assertEqual(data.dtype, np.uint8)
+            np.testing.assert_array_equal(data, self.bits[:, ch])
+
+    def test_time_axis(self):
+        parser = comtrade.ComtradeParser(self.cfg)
+        expected = np.arange(SAMPLE_COUNT) / SAMPLE_RATE
+        np.testing.assert_allclose(parser.t, expected)
+
+    def test_dat_path(self):
+        parser = comtrade.ComtradeParser(self.cfg.replace('.cfg', '.dat'))
+        self.assertEqual(parser.result, 'parsed')
+
+    def test_truncated_dat(self):
+        datPath = self.cfg.replace('.cfg', '.dat')
+        unitSize = op.getsize(datPath) // SAMPLE_COUNT
+        # keep 10 records and half of the 11th
+        os.truncate(datPath, unitSize * 10 + unitSize // 2)
+        parser = comtrade.ComtradeParser(self.cfg)
+        self.assertEqual(parser.dat.sampleCount, 10)
+        self.assertEqual(len(parser.t), 10)
+        np.testing.assert_allclose(parser.analog['U1(V)'],
+                                   self.raw[:10, 1] * 2.0 - 3.0)
+        np.testing.assert_array_equal(parser.digital['S17'],
+                                      self.bits[:10, 17])
+
+    def test_empty_dat(self):
+        os.truncate(self.cfg.replace('.cfg', '.dat'), 0)
+        parser = comtrade.ComtradeParser(self.cfg)
+        self.assertEqual(parser.result, 'parsed')
+        self.assertEqual(len(parser.t), 0)
+        self.assertEqual(len(parser.analog['U0(V)']), 0)
+        self.assertEqual(len(parser.digital['S0']), 0)
+
+    def test_dat_changed_after_parse(self):
+        parser = comtrade.ComtradeParser(self.cfg)
+        parser.analog
+        os.truncate(self.cfg.replace('.cfg', '.dat'), 0)
+        np.testing.assert_array_equal(parser.digital['S3'], self.bits[:, 3])
+
+    def test_channel_data_outlives_parser(self):
+        config = comtrade.ComtradeParser(self.cfg).config
+        np.testing.assert_allclose(config.analogInfo[0].data(),
+                                   self.raw[:, 0] * 0.5 + 1.0)
+
+    def test_missing_cfg(self):
+        parser = comtrade.ComtradeParser(op.join(self.dir, 'missing.cfg'))
+        self.assertEqual(parser.result, 'no file')
+        self.assertEqual(parser.analog, {})
+
+    def test_csv(self):
+        parser = comtrade.ComtradeParser(self.cfg)
+        parser.plotchannel = 'ALL'
+        parser.savefig('csv')
+        with open(parser.path + '_ALL.csv') as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines[0].split(',')[:4],
+                         ['U0(V)', 'U1(V)', 'U2(V)', 'S0'])
+        self.assertEqual(len(lines), SAMPLE_COUNT + 1)
+
+    def test_parse_many(self):
+        other, raw, bits = writewave(self.dir, 'other')
+        missing = op.join(self.dir, 'missing.cfg')
+        parsers = comtrade.parse_many([self.cfg, missing, other],
+                                      n_workers=2, chunksize=1)
+        self.assertEqual([p.result for p in parsers],
+                         ['parsed', 'no file', 'parsed'])
+        np.testing.assert_array_equal(parsers[2].digital['S19'],
+                                      bits[:, 19])
+
+
+if __name__ == '__main__':
+    unittest.main()